@@ -4,11 +4,14 @@ from grader_backend.utils.parse_document import extract_text_from_file_bytes, ex
 from grader_backend.utils.nim_client import chat_completion,embedding
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import Dict, List, Literal, Optional, Tuple, Union
+from collections import Counter
+import asyncio
 import json
 import os
 import logging
+import statistics
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -56,16 +59,48 @@ class GradeCriterionResult(BaseModel):
     score: float
     explanation: str
 
+class ConsistencyConfig(BaseModel):
+    max_samples: int = Field(5, ge=2, le=15, description="Upper bound on LLM calls for this grade")
+    min_samples: int = Field(2, ge=2, le=15, description="Samples issued concurrently before checking agreement")
+    batch_size: int = Field(2, ge=1, description="Extra samples issued concurrently per round when samples disagree")
+    tolerance: float = Field(1.0, ge=0, description="Max per-criterion score spread (0-10) that counts as agreement")
+    aggregation: Literal["median", "majority"] = "median"
+    temperature: float = Field(0.7, ge=0, le=2)
+
+    @model_validator(mode="after")
+    def check_sample_bounds(self):
+        if self.min_samples > self.max_samples:
+            raise ValueError("min_samples cannot exceed max_samples")
+        return self
+
+class CriterionConsistency(BaseModel):
+    criterion_id: str
+    score_variance: float
+    score_spread: float
+    label_agreement: float = Field(..., description="Share of all samples that picked the aggregated level_label")
+
+class ConsistencyReport(BaseModel):
+    samples_requested: int
+    samples_used: int
+    agreed: bool
+    early_stopped: bool
+    overall_score_variance: float
+    criteria: List[CriterionConsistency]
+
 class GradeSubmissionRequest(BaseModel):
     objective: str
     rubric: Rubric
     submission_text: str
+    consistency: Optional[ConsistencyConfig] = Field(
+        None, description="Enable self-consistency sampling instead of a single grading call"
+    )
 
 class GradeSubmissionResponse(BaseModel):
     results: List[GradeCriterionResult]
     overall_score: float
     overall_comment: str
     raw_model_output: Optional[dict] = None
+    consistency: Optional[ConsistencyReport] = None
 
 
 # --- Prompt builder helper ---
@@ -217,6 +252,268 @@ async def generate_rubric_endpoint(req: RubricGenerateRequest):
         )
 
     return RubricGenerateResponse(rubric=rubric, raw_model_output=response)
+
+
+def parse_grading_response(response: dict) -> Tuple[List[GradeCriterionResult], float, str]:
+    """
+    Turn a raw chat-completion response into (criterion_results, overall_score, overall_comment).
+    Raises on anything that cannot be parsed into the grading schema.
+    """
+    if "choices" not in response or not response["choices"]:
+        raise ValueError(f"No 'choices' in model response: {response}")
+
+    choice = response["choices"][0]
+    text = extract_text_from_choice(choice)
+
+    # Log for debugging
+    logger.info("=== RAW LLM GRADE TEXT START ===")
+    logger.info(text)
+    logger.info("=== RAW LLM GRADE TEXT END ===")
+
+    # Strip code fences like ```json ... ```
+    if text.startswith("```"):
+        parts = text.split("```")
+        for part in parts:
+            p = part.strip()
+            # ```json\n{...}
+            if p.lower().startswith("json"):
+                text = p[4:].lstrip()
+                break
+
+    # Try direct JSON parse first
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        # Fallback: try to extract the largest {...} block
+        first = text.find("{")
+        last = text.rfind("}")
+        if first != -1 and last != -1 and last > first:
+            candidate = text[first : last + 1]
+            parsed = json.loads(candidate)
+        else:
+            # Re-raise the original error with context
+            raise
+
+    # Validate into Pydantic models
+    criterion_results: List[GradeCriterionResult] = []
+    for item in parsed.get("criterion_results", []):
+        normalized = {
+            # LLM may return "criterion_id" OR "id"
+            "criterion_id": item.get("criterion_id") or item.get("id") or "",
+            "level_label": item.get("level_label") or "",
+            "score": float(item.get("score", 0.0)),
+            # LLM may call this "explanation" or "comment"
+            "explanation": item.get("explanation") or item.get("comment") or "",
+        }
+        criterion_results.append(GradeCriterionResult(**normalized))
+
+    overall_score = float(parsed.get("overall_score", 0.0))
+    overall_comment = str(parsed.get("overall_comment", ""))
+
+    return criterion_results, overall_score, overall_comment
+
+
+# --- Consistency mode helpers ---
+
+# (criterion_results, overall_score, overall_comment, raw_response)
+GradeSample = Tuple[List[GradeCriterionResult], float, str, dict]
+
+
+def _sample_grade(
+    messages: List[dict], model_id: str, temperature: float
+) -> Union[GradeSample, Exception]:
+    """
+    Run one grading call. A failed NIM call or unusable model output is returned
+    rather than raised, so it only costs this sample.
+    """
+    try:
+        response = chat_completion(
+            messages=messages,
+            model_id=model_id,
+            temperature=temperature,
+            max_tokens=2048,
+        )
+    except RuntimeError as e:
+        logger.warning("Discarding failed consistency sample: %s", e)
+        return e
+
+    try:
+        results, overall_score, overall_comment = parse_grading_response(response)
+    except Exception as e:
+        # Malformed output surfaces as anything from JSONDecodeError to TypeError
+        logger.warning("Discarding unparseable consistency sample: %r", e)
+        return e
+    return results, overall_score, overall_comment, response
+
+
+def _results_by_criterion(
+    samples: List[GradeSample], rubric: Rubric
+) -> Dict[str, Dict[int, GradeCriterionResult]]:
+    # Maps rubric criterion id -> {sample index: result}, in rubric order.
+    # Ids outside the rubric are dropped, and only a sample's first result per id counts.
+    by_criterion: Dict[str, Dict[int, GradeCriterionResult]] = {
+        c.id: {} for c in rubric.criteria
+    }
+    for idx, (results, _, _, _) in enumerate(samples):
+        for r in results:
+            if r.criterion_id in by_criterion:
+                by_criterion[r.criterion_id].setdefault(idx, r)
+    return by_criterion
+
+
+def samples_agree(samples: List[GradeSample], rubric: Rubric, cfg: ConsistencyConfig) -> bool:
+    """
+    True when at least two samples all graded every rubric criterion and each
+    criterion's score stays within cfg.tolerance. In majority mode the level
+    labels must also be unanimous.
+    """
+    if len(samples) < 2:
+        return False
+
+    for items in _results_by_criterion(samples, rubric).values():
+        # A criterion some samples skipped is not agreement
+        if len(items) != len(samples):
+            return False
+        scores = [r.score for r in items.values()]
+        if max(scores) - min(scores) > cfg.tolerance:
+            return False
+        if cfg.aggregation == "majority" and len({r.level_label for r in items.values()}) > 1:
+            return False
+    return True
+
+
+def weighted_overall_score(results: List[GradeCriterionResult], rubric: Rubric) -> Optional[float]:
+    """Rubric-weighted average of criterion scores, or None if no weighted criterion was graded."""
+    scores = {r.criterion_id: r.score for r in results}
+    graded = [c for c in rubric.criteria if c.id in scores]
+    total_weight = sum(c.weight for c in graded)
+    if total_weight <= 0:
+        return None
+    return sum(c.weight * scores[c.id] for c in graded) / total_weight
+
+
+def aggregate_samples(
+    samples: List[GradeSample], rubric: Rubric, cfg: ConsistencyConfig
+) -> Tuple[List[GradeCriterionResult], List[CriterionConsistency]]:
+    """
+    Combine samples into one result per rubric criterion, in rubric order.
+      - median:   median score, label/explanation from the sample closest to it
+      - majority: most common level_label, median score among samples that chose it
+    Also returns per-criterion variance stats.
+    """
+    aggregated: List[GradeCriterionResult] = []
+    stats: List[CriterionConsistency] = []
+
+    for criterion_id, items in _results_by_criterion(samples, rubric).items():
+        if not items:
+            continue
+        results = list(items.values())
+        scores = [r.score for r in results]
+
+        if cfg.aggregation == "majority":
+            label = Counter(r.level_label for r in results).most_common(1)[0][0]
+            candidates = [r for r in results if r.level_label == label]
+        else:
+            candidates = results
+
+        score = float(statistics.median(r.score for r in candidates))
+        representative = min(candidates, key=lambda r: abs(r.score - score))
+        voters = [r for r in results if r.level_label == representative.level_label]
+
+        aggregated.append(
+            GradeCriterionResult(
+                criterion_id=criterion_id,
+                level_label=representative.level_label,
+                score=score,
+                explanation=representative.explanation,
+            )
+        )
+        stats.append(
+            CriterionConsistency(
+                criterion_id=criterion_id,
+                score_variance=statistics.pvariance(scores) if len(scores) > 1 else 0.0,
+                score_spread=max(scores) - min(scores),
+                label_agreement=len(voters) / len(samples),
+            )
+        )
+
+    return aggregated, stats
+
+
+async def grade_with_consistency(
+    messages: List[dict], model_id: str, rubric: Rubric, cfg: ConsistencyConfig
+) -> GradeSubmissionResponse:
+    """
+    Self-consistency grading: issue samples concurrently, stop as soon as they
+    agree within cfg.tolerance, and never exceed cfg.max_samples LLM calls.
+    """
+    first_round = min(cfg.min_samples, cfg.max_samples)
+    samples: List[GradeSample] = []
+    requested = 0
+    agreed = False
+    last_error: Optional[Exception] = None
+
+    while requested < cfg.max_samples:
+        n = first_round if requested == 0 else min(cfg.batch_size, cfg.max_samples - requested)
+        requested += n
+
+        # chat_completion is blocking, so fan the round out over worker threads
+        outcomes = await asyncio.gather(
+            *(
+                asyncio.to_thread(_sample_grade, messages, model_id, cfg.temperature)
+                for _ in range(n)
+            )
+        )
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                last_error = outcome
+            else:
+                samples.append(outcome)
+
+        if len(samples) >= first_round and samples_agree(samples, rubric, cfg):
+            agreed = True
+            break
+
+    if not samples:
+        raise HTTPException(
+            status_code=502,
+            detail=f"All {requested} grading samples failed: {last_error}",
+        )
+
+    results, criteria_stats = aggregate_samples(samples, rubric, cfg)
+    overall_scores = [s[1] for s in samples]
+
+    overall_score = weighted_overall_score(results, rubric)
+    if overall_score is None:
+        overall_score = float(statistics.median(overall_scores))
+    # Comment and raw output come from the sample whose own score is nearest the reported one
+    closest = min(samples, key=lambda s: abs(s[1] - overall_score))
+
+    logger.info(
+        "Consistency grading used %d/%d samples (agreed=%s)",
+        requested,
+        cfg.max_samples,
+        agreed,
+    )
+
+    return GradeSubmissionResponse(
+        results=results,
+        overall_score=overall_score,
+        overall_comment=closest[2],
+        raw_model_output=closest[3],
+        consistency=ConsistencyReport(
+            samples_requested=requested,
+            samples_used=len(samples),
+            agreed=agreed,
+            early_stopped=agreed and requested < cfg.max_samples,
+            overall_score_variance=(
+                statistics.pvariance(overall_scores) if len(overall_scores) > 1 else 0.0
+            ),
+            criteria=criteria_stats,
+        ),
+    )
+
+
 @app.post("/grade", response_model=GradeSubmissionResponse)
 async def grade_submission_endpoint(req: GradeSubmissionRequest):
     # 1) Build prompt
@@ -227,6 +524,10 @@ async def grade_submission_endpoint(req: GradeSubmissionRequest):
     if not model_id:
         raise HTTPException(status_code=500, detail="NIM_CHAT_MODEL env var not set")
 
+    # 2b) Consistency mode: several concurrent samples with early stopping
+    if req.consistency is not None:
+        return await grade_with_consistency(messages, model_id, req.rubric, req.consistency)
+
     # 3) Call NIM / OpenAI-compatible endpoint
     try:
         response = chat_completion(
@@ -238,60 +539,9 @@ async def grade_submission_endpoint(req: GradeSubmissionRequest):
     except RuntimeError as e:
         raise HTTPException(status_code=502, detail=str(e))
 
-    # 4) Pull out the first choice and raw text
+    # 4) Parse and validate the model output
     try:
-        if "choices" not in response or not response["choices"]:
-            raise ValueError(f"No 'choices' in model response: {response}")
-
-        choice = response["choices"][0]
-        text = extract_text_from_choice(choice)
-
-        # Log for debugging
-        logger.info("=== RAW LLM GRADE TEXT START ===")
-        logger.info(text)
-        logger.info("=== RAW LLM GRADE TEXT END ===")
-
-        # 5) Strip code fences like ```json ... ```
-        if text.startswith("```"):
-            parts = text.split("```")
-            for part in parts:
-                p = part.strip()
-                # ```json\n{...}
-                if p.lower().startswith("json"):
-                    text = p[4:].lstrip()
-                    break
-
-        # 6) Try direct JSON parse first
-        try:
-            parsed = json.loads(text)
-        except json.JSONDecodeError:
-            # Fallback: try to extract the largest {...} block
-            first = text.find("{")
-            last = text.rfind("}")
-            if first != -1 and last != -1 and last > first:
-                candidate = text[first : last + 1]
-                parsed = json.loads(candidate)
-            else:
-                # Re-raise the original error with context
-                raise
-
-        # 7) Validate into Pydantic models
-        criterion_results: List[GradeCriterionResult] = []
-        for item in parsed.get("criterion_results", []):
-            normalized = {
-                # LLM may return "criterion_id" OR "id"
-                "criterion_id": item.get("criterion_id") or item.get("id") or "",
-                "level_label": item.get("level_label") or "",
-                "score": float(item.get("score", 0.0)),
-                # LLM may call this "explanation" or "comment"
-                "explanation": item.get("explanation") or item.get("comment") or "",
-            }
-            criterion_results.append(GradeCriterionResult(**normalized))
-
-        overall_score = float(parsed.get("overall_score", 0.0))
-        overall_comment = str(parsed.get("overall_comment", ""))
-
-
+        criterion_results, overall_score, overall_comment = parse_grading_response(response)
     except Exception as e:
         # Log the full traceback on the server
         logger.exception("Failed to parse grading JSON from model output")
@@ -300,7 +550,7 @@ async def grade_submission_endpoint(req: GradeSubmissionRequest):
             detail=f"Failed to parse grading JSON from model output: {e}",
         )
 
-    # 8) Return structured response
+    # 5) Return structured response
     return GradeSubmissionResponse(
         results=criterion_results,
         overall_score=overall_score,
@@ -0,0 +1,248 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+import grader_backend.main as grader
+
+
+RUBRIC = grader.Rubric(
+    title="Essay",
+    criteria=[
+        grader.RubricCriterion(
+            id="clarity",
+            name="Clarity",
+            description="Clear writing",
+            weight=0.5,
+            levels=[grader.RubricCriterionLevel(label="Good", descriptor="clear")],
+        ),
+        grader.RubricCriterion(
+            id="evidence",
+            name="Evidence",
+            description="Supported claims",
+            weight=0.5,
+            levels=[grader.RubricCriterionLevel(label="Good", descriptor="supported")],
+        ),
+    ],
+    overall_notes=None,
+)
+
+
+def _response(scores, overall=None, comment="ok"):
+    """Build a chat-completion dict; scores maps criterion id -> (label, score)."""
+    body = {
+        "criterion_results": [
+            {"criterion_id": cid, "level_label": label, "score": score, "explanation": cid}
+            for cid, (label, score) in scores.items()
+        ],
+        "overall_score": overall if overall is not None else 0.0,
+        "overall_comment": comment,
+    }
+    return {"choices": [{"message": {"content": json.dumps(body)}}]}
+
+
+def _stub(monkeypatch, responses):
+    """Make chat_completion return responses in order; exceptions are raised."""
+    calls = iter(responses)
+
+    def fake_chat_completion(**kwargs):
+        item = next(calls)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    monkeypatch.setattr(grader, "chat_completion", fake_chat_completion)
+
+
+def _grade(cfg, rubric=RUBRIC):
+    return asyncio.run(grader.grade_with_consistency([], "model", rubric, cfg))
+
+
+def test_stops_early_when_first_round_agrees(monkeypatch):
+    good = {"clarity": ("Good", 8), "evidence": ("Good", 6)}
+    _stub(monkeypatch, [_response(good, 7), _response(good, 7)])
+
+    resp = _grade(grader.ConsistencyConfig(max_samples=5))
+
+    assert resp.consistency.samples_requested == 2
+    assert resp.consistency.agreed is True
+    assert resp.consistency.early_stopped is True
+    assert resp.overall_score == pytest.approx(7.0)
+
+
+def test_caps_at_max_samples_when_samples_disagree(monkeypatch):
+    _stub(
+        monkeypatch,
+        [
+            _response({"clarity": ("Good", 9), "evidence": ("Good", 9)}),
+            _response({"clarity": ("Weak", 2), "evidence": ("Weak", 2)}),
+            _response({"clarity": ("Good", 8), "evidence": ("Good", 8)}),
+            _response({"clarity": ("Weak", 3), "evidence": ("Weak", 3)}),
+        ],
+    )
+
+    resp = _grade(grader.ConsistencyConfig(max_samples=4, batch_size=2))
+
+    assert resp.consistency.samples_requested == 4
+    assert resp.consistency.samples_used == 4
+    assert resp.consistency.agreed is False
+    assert resp.consistency.early_stopped is False
+    assert resp.consistency.criteria[0].score_variance > 0
+
+
+def test_all_samples_failing_returns_502(monkeypatch):
+    _stub(monkeypatch, [RuntimeError("NIM down"), RuntimeError("NIM down")])
+
+    with pytest.raises(HTTPException) as exc:
+        _grade(grader.ConsistencyConfig(max_samples=2))
+
+    assert exc.value.status_code == 502
+
+
+def test_malformed_sample_only_costs_that_sample(monkeypatch):
+    good = _response({"clarity": ("Good", 8), "evidence": ("Good", 8)}, 8)
+    null_score = _response({"clarity": ("Good", None), "evidence": ("Good", 8)})
+    _stub(monkeypatch, [good, null_score, good, good])
+
+    resp = _grade(grader.ConsistencyConfig(min_samples=2, max_samples=4, batch_size=1))
+
+    assert resp.consistency.samples_requested == 3
+    assert resp.consistency.samples_used == 2
+    assert resp.consistency.agreed is True
+    assert resp.overall_score == pytest.approx(8.0)
+
+
+def test_all_samples_malformed_returns_502(monkeypatch):
+    array = {"choices": [{"message": {"content": "[1, 2]"}}]}
+    strings = {"choices": [{"message": {"content": '{"criterion_results": ["x"]}'}}]}
+    _stub(monkeypatch, [array, strings])
+
+    with pytest.raises(HTTPException) as exc:
+        _grade(grader.ConsistencyConfig(max_samples=2))
+
+    assert exc.value.status_code == 502
+
+
+def test_min_samples_cannot_exceed_max_samples():
+    with pytest.raises(ValidationError):
+        grader.ConsistencyConfig(min_samples=8, max_samples=3)
+
+
+def test_single_sample_is_never_reported_as_agreement(monkeypatch):
+    good = _response({"clarity": ("Good", 8), "evidence": ("Good", 8)})
+    _stub(monkeypatch, [good, RuntimeError("NIM down")])
+
+    resp = _grade(grader.ConsistencyConfig(max_samples=2))
+
+    assert resp.consistency.samples_used == 1
+    assert resp.consistency.agreed is False
+
+
+def test_median_vs_majority_aggregation():
+    one = grader.Rubric(title="t", criteria=RUBRIC.criteria[:1], overall_notes=None)
+    samples = [
+        (grader.parse_grading_response(_response({"clarity": (label, score)})) + ({},))
+        for label, score in [("Good", 8), ("Good", 7), ("Weak", 3)]
+    ]
+
+    median_results, _ = grader.aggregate_samples(samples, one, grader.ConsistencyConfig())
+    majority_results, stats = grader.aggregate_samples(
+        samples, one, grader.ConsistencyConfig(aggregation="majority")
+    )
+
+    assert median_results[0].score == 7.0
+    assert majority_results[0].level_label == "Good"
+    assert majority_results[0].score == 7.5
+    assert stats[0].label_agreement == pytest.approx(2 / 3)
+    assert grader.weighted_overall_score(majority_results, one) == 7.5
+
+
+def test_missing_criterion_counts_as_disagreement():
+    cfg = grader.ConsistencyConfig()
+    full = grader.parse_grading_response(
+        _response({"clarity": ("Good", 8), "evidence": ("Good", 8)})
+    ) + ({},)
+    # Same number of results, but "evidence" is missing and "clarity" repeated
+    partial = grader.parse_grading_response(_response({"clarity": ("Good", 8)})) + ({},)
+    partial[0].append(partial[0][0])
+
+    assert grader.samples_agree([full, full], RUBRIC, cfg) is True
+    assert grader.samples_agree([full, partial], RUBRIC, cfg) is False
+
+
+def test_aggregation_follows_rubric_and_counts_each_sample_once():
+    first = grader.parse_grading_response(
+        _response({"bogus": ("Good", 1), "evidence": ("Good", 6), "clarity": ("Good", 8)})
+    ) + ({},)
+    second = grader.parse_grading_response(
+        _response({"clarity": ("Good", 6), "evidence": ("Good", 6)})
+    ) + ({},)
+    # A repeated criterion in one sample must not count twice
+    second[0].append(
+        grader.GradeCriterionResult(criterion_id="clarity", level_label="Weak", score=0, explanation="")
+    )
+
+    results, stats = grader.aggregate_samples(
+        [first, second], RUBRIC, grader.ConsistencyConfig()
+    )
+
+    assert [r.criterion_id for r in results] == ["clarity", "evidence"]
+    assert [s.criterion_id for s in stats] == ["clarity", "evidence"]
+    assert results[0].score == 7.0
+    assert stats[0].score_spread == 2.0
+
+
+def _grade_payload(**extra):
+    return {
+        "objective": "Write an essay",
+        "rubric": RUBRIC.model_dump(),
+        "submission_text": "My essay",
+        **extra,
+    }
+
+
+def test_grade_endpoint_without_consistency_is_single_shot(monkeypatch):
+    calls = []
+
+    def fake_chat_completion(**kwargs):
+        calls.append(kwargs)
+        return _response({"clarity": ("Good", 8), "evidence": ("Good", 6)}, 7, "Solid work")
+
+    monkeypatch.setattr(grader, "chat_completion", fake_chat_completion)
+
+    resp = TestClient(grader.app).post("/grade", json=_grade_payload())
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert len(calls) == 1
+    assert calls[0]["temperature"] == 0.2
+    assert body["overall_score"] == 7
+    assert body["overall_comment"] == "Solid work"
+    assert [r["criterion_id"] for r in body["results"]] == ["clarity", "evidence"]
+    assert body["consistency"] is None
+
+
+def test_grade_endpoint_with_consistency_samples(monkeypatch):
+    good = _response({"clarity": ("Good", 8), "evidence": ("Good", 6)}, 7)
+    _stub(monkeypatch, [good, good])
+
+    resp = TestClient(grader.app).post(
+        "/grade", json=_grade_payload(consistency={"max_samples": 4})
+    )
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["consistency"]["samples_requested"] == 2
+    assert body["consistency"]["agreed"] is True
+    assert body["overall_score"] == pytest.approx(7.0)
+
+
+def test_grade_endpoint_rejects_min_samples_above_max_samples():
+    resp = TestClient(grader.app).post(
+        "/grade", json=_grade_payload(consistency={"min_samples": 8, "max_samples": 3})
+    )
+
+    assert resp.status_code == 422